@@ -29,8 +29,16 @@ doit :
   `MAILING_MODELE_PARAMS_ENVELOPPE` sous le format 'nom_application.nom_modele'
 * L'envoi est temporisé, d'un nombre de secondes indiqué dans le paramètre
 `MAILING_TEMPORISATION`. Défaut: 2 secondes
+* Les adresses sont comparées après normalisation (casse, espaces) : si
+plusieurs enveloppes d'un même modèle aboutissent à la même adresse, une seule
+d'entre elles est envoyée. Le paramètre ``doublons`` de `envoyer` indique le
+traitement des autres (voir `DOUBLONS_IGNORER`, `DOUBLONS_FUSIONNER` et
+`DOUBLONS_ENVOYER`). Une enveloppe fusionnée est logée avec, dans
+`EntreeLog.doublon_de`, l'enveloppe à laquelle elle a été rattachée : seules
+les entrées où ce champ est vide correspondent à des courriels envoyés.
 
 """
+import logging
 import random
 import smtplib
 import string
@@ -42,9 +50,16 @@ from django.db import models, transaction
 from django.db.models.fields import CharField, TextField, BooleanField, DateTimeField
 from django.db.models.fields.related import ForeignKey
 import datetime
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from django.core.mail.message import SafeMIMEText, forbid_multi_line_headers,\
+    make_msgid
 from django.template.base import Template
 from django.template.context import Context
 from django.conf import settings
+from django.utils.encoding import smart_str
+
+logger = logging.getLogger(__name__)
 
 class ModeleCourriel(models.Model):
     """
@@ -122,10 +137,141 @@ class EntreeLog(models.Model):
     adresse = CharField(max_length=256)
     date_heure_envoi = DateTimeField(default=datetime.datetime.now)
     erreur = TextField(null=True)
+    # enveloppe effectivement envoyée, lorsque cette entrée enregistre une
+    # fusion de doublon (DOUBLONS_FUSIONNER) plutôt qu'un envoi
+    doublon_de = ForeignKey(Enveloppe, null=True, related_name='doublons')
+
+
+# Traitement des enveloppes dont l'adresse a déjà reçu le courriel du modèle
+# (par une autre enveloppe, pendant cet envoi ou un envoi précédent) :
+# - ignorer : l'enveloppe n'est pas envoyée, rien n'est enregistré, elle
+#   sera donc réexaminée au prochain envoi
+# - fusionner : l'enveloppe n'est pas envoyée, mais une `EntreeLog` est
+#   enregistrée, avec l'enveloppe envoyée dans `doublon_de`
+# - envoyer : l'enveloppe est envoyée quand même
+DOUBLONS_IGNORER = 'ignorer'
+DOUBLONS_FUSIONNER = 'fusionner'
+DOUBLONS_ENVOYER = 'envoyer'
+DOUBLONS = (DOUBLONS_IGNORER, DOUBLONS_FUSIONNER, DOUBLONS_ENVOYER)
+
+
+def normaliser_adresse(adresse):
+    u"""
+    Retourne la forme normalisée d'une adresse, servant à détecter les
+    doublons : sans espaces autour et en minuscules.
+    """
+    return adresse.strip().lower()
+
+
+def indexer_adresses(modele):
+    u"""
+    Retourne un dictionnaire {adresse normalisée: id de l'enveloppe} des
+    adresses auxquelles le courriel du modèle a déjà été envoyé sans erreur.
+    """
+    entrees = EntreeLog.objects.filter(enveloppe__modele=modele,
+        erreur__isnull=True, doublon_de__isnull=True).order_by('id').values_list('adresse', 'enveloppe')
+    index = {}
+    for adresse, enveloppe_id in entrees:
+        index.setdefault(normaliser_adresse(adresse), enveloppe_id)
+    return index
+
+class FabriqueCourriel(object):
+    u"""
+    Fabrique les courriels d'un envoi. Le sujet, l'expéditeur et les entêtes
+    communs à tous les destinataires ne sont encodés qu'une fois, à la
+    création de la fabrique ; pour chaque destinataire il ne reste qu'à
+    encoder le corps et à ajouter les entêtes To, Date et Message-ID.
+
+    Les messages obtenus sont identiques à ceux que produit
+    `EmailMessage.message()` de Django 1.4 avec les mêmes paramètres.
+    """
+
+    def __init__(self, sujet, adresse_expediteur, html=False, headers=None):
+        self.sujet = sujet
+        self.adresse_expediteur = adresse_expediteur
+        # "text" plutôt que "plain" : conservé tel quel pour ne pas modifier
+        # les messages produits jusqu'ici
+        self.content_subtype = "html" if html else "text"
+        self.headers = headers or {}
+        self.encoding = settings.DEFAULT_CHARSET
+        self.entetes_debut = [
+            forbid_multi_line_headers('Subject', sujet, self.encoding),
+            forbid_multi_line_headers('From',
+                self.headers.get('From', adresse_expediteur), self.encoding),
+        ]
+        # un entête To fixe remplace la liste des destinataires
+        self.entete_to = None
+        if 'To' in self.headers:
+            self.entete_to = forbid_multi_line_headers('To',
+                self.headers['To'], self.encoding)
+        noms_entetes = [nom.lower() for nom in self.headers]
+        self.date = 'date' not in noms_entetes
+        self.message_id = 'message-id' not in noms_entetes
+        self.entetes_fin = [forbid_multi_line_headers(nom, valeur, self.encoding)
+            for nom, valeur in self.headers.items()
+            if nom.lower() not in ('from', 'to')]
+
+    def creer(self, corps, adresse_envoi):
+        u"""
+        Retourne le courriel à envoyer à ``adresse_envoi``.
+        """
+        message = CourrielFabrique(self.sujet, corps, self.adresse_expediteur,
+            [adresse_envoi], headers=self.headers)
+        message.content_subtype = self.content_subtype
+        message.fabrique = self
+        return message
+
+
+class CourrielFabrique(EmailMessage):
+    u"""
+    Courriel créé par une `FabriqueCourriel`, dont il réutilise les entêtes
+    déjà encodés.
+    """
+    fabrique = None
+
+    def utilise_fabrique(self):
+        u"""
+        Indique si le message peut être produit à partir des entêtes de la
+        fabrique, c'est-à-dire s'il n'a pas été modifié depuis sa création
+        et ne comporte rien que la fabrique ne sache traiter.
+        """
+        fabrique = self.fabrique
+        return fabrique is not None and not self.cc and \
+            not self.attachments and \
+            (self.encoding or settings.DEFAULT_CHARSET) == fabrique.encoding and \
+            self.subject == fabrique.sujet and \
+            self.from_email == fabrique.adresse_expediteur and \
+            self.extra_headers is fabrique.headers
+
+    def message(self):
+        # Reprend pas à pas EmailMessage.message() de Django 1.4 (ordre et
+        # traitement des entêtes) : à revoir à chaque changement de version
+        # de Django, test_fabrique_courriel vérifiant l'équivalence.
+        if not self.utilise_fabrique():
+            return super(CourrielFabrique, self).message()
+        fabrique = self.fabrique
+        msg = SafeMIMEText(smart_str(self.body, fabrique.encoding),
+            self.content_subtype, fabrique.encoding)
+        # les entêtes de la fabrique sont déjà passés par
+        # forbid_multi_line_headers, on évite SafeMIMEText.__setitem__
+        for nom, valeur in fabrique.entetes_debut:
+            MIMEText.__setitem__(msg, nom, valeur)
+        if fabrique.entete_to is None:
+            msg['To'] = ', '.join(self.to)
+        else:
+            MIMEText.__setitem__(msg, *fabrique.entete_to)
+        if fabrique.date:
+            msg['Date'] = formatdate()
+        if fabrique.message_id:
+            msg['Message-ID'] = make_msgid()
+        for nom, valeur in fabrique.entetes_fin:
+            MIMEText.__setitem__(msg, nom, valeur)
+        return msg
+
 
 @transaction.commit_manually
 def envoyer(code_modele, adresse_expediteur, site=None, url_name=None,
-            limit=None, retry_errors=True):
+            limit=None, retry_errors=True, doublons=DOUBLONS_IGNORER):
     u"""
     Cette fonction procède à l'envoi proprement dit, pour toutes les enveloppes
     du modele ayant pour code :code_modele. Si ``site``, ``url_name`` sont spécifiés
@@ -137,26 +283,53 @@ def envoyer(code_modele, adresse_expediteur, site=None, url_name=None,
     :param url_name: le nom de l'URL à générer
     :param limit: indique un nombre maximal de courriels à envoyer pour cet appel
     :param retry_errors: les envois en erreur doivent-ils être retentés ou non ?
+    :param doublons: traitement des enveloppes dont l'adresse (normalisée) a
+     déjà reçu ce courriel : `DOUBLONS_IGNORER`, `DOUBLONS_FUSIONNER` ou
+     `DOUBLONS_ENVOYER`
 
     .. warning:: L'utilisation conjointe d'une limite (paramètre ``limit``) et
      de ``retry_errors`` pourrait faire en sorte que certains courriels ne soient
      jamais envoyés (si il y a plus de courriels en erreur que ``limit``)
     """
+    if doublons not in DOUBLONS:
+        raise ValueError(u"doublons : valeur inconnue %r" % (doublons,))
     modele = ModeleCourriel.objects.get(code=code_modele)
-    enveloppes = Enveloppe.objects.filter(modele=modele)
+    # la première enveloppe d'une adresse est celle qui est envoyée
+    enveloppes = Enveloppe.objects.filter(modele=modele).order_by('id')
     temporisation = getattr(settings, 'MAILING_TEMPORISATION', 2)
     counter = 0
+    adresses_envoyees = indexer_adresses(modele)
+    fabrique = FabriqueCourriel(modele.sujet,
+        adresse_expediteur,                 # adresse de retour
+        html=modele.html,
+        headers={'precedence' : 'bulk'}     # selon les conseils de google
+    )
     try:
         for enveloppe in enveloppes:
             # on vérifie qu'on n'a pas déjà envoyé ce courriel à
-            # cet établissement et à cette adresse
+            # cet établissement et à cette adresse (aux différences de casse
+            # et d'espaces près)
             adresse_envoi = enveloppe.get_adresse()
-            entree_log = EntreeLog.objects.filter(enveloppe=enveloppe,
-                adresse=adresse_envoi)
+            adresse_normalisee = normaliser_adresse(adresse_envoi)
+            entree_log = EntreeLog.objects.filter(enveloppe=enveloppe)
             if retry_errors:
                 entree_log = entree_log.filter(erreur__isnull=True)
 
-            if entree_log.count() > 0:
+            if adresse_normalisee in [normaliser_adresse(adresse) for adresse
+                    in entree_log.values_list('adresse', flat=True)]:
+                continue
+
+            enveloppe_envoyee = adresses_envoyees.get(adresse_normalisee)
+            if enveloppe_envoyee is not None and \
+                    enveloppe_envoyee != enveloppe.id and \
+                    doublons != DOUBLONS_ENVOYER:
+                logger.info(u"Enveloppe %s : %s déjà envoyé à l'adresse %s "
+                    u"(enveloppe %s), doublon %s", enveloppe.id, modele.code,
+                    adresse_envoi, enveloppe_envoyee, doublons)
+                if doublons == DOUBLONS_FUSIONNER:
+                    EntreeLog.objects.create(enveloppe=enveloppe,
+                        adresse=adresse_envoi, doublon_de_id=enveloppe_envoyee)
+                    transaction.commit()
                 continue
 
             modele_corps = Template(enveloppe.modele.corps)
@@ -169,12 +342,7 @@ def envoyer(code_modele, adresse_expediteur, site=None, url_name=None,
                 contexte_corps['url'] = url
 
             corps = modele_corps.render(Context(contexte_corps))
-            message = EmailMessage(enveloppe.modele.sujet,
-                corps,
-                adresse_expediteur,     # adresse de retour
-                [adresse_envoi],                # adresse du destinataire
-                headers={'precedence' : 'bulk'} # selon les conseils de google
-            )
+            message = fabrique.creer(corps, adresse_envoi)
             try:
                 # Attention en DEV, devrait simplement écrire le courriel
                 # dans la console, cf. paramètre EMAIL_BACKEND dans conf.py
@@ -183,11 +351,11 @@ def envoyer(code_modele, adresse_expediteur, site=None, url_name=None,
                 # mais attention car les adresses qui sont dans la base
                 # seront utilisées: modifier les données pour y mettre des
                 # adresses de test plutôt que les vraies
-                message.content_subtype = "html" if enveloppe.modele.html else "text"
                 entree_log = EntreeLog()
                 entree_log.enveloppe = enveloppe
                 entree_log.adresse = adresse_envoi
                 message.send()
+                adresses_envoyees.setdefault(adresse_normalisee, enveloppe.id)
                 counter += 1
                 time.sleep(temporisation)
             except (smtplib.socket.error, smtplib.SMTPException) as e:
@@ -1,6 +1,7 @@
 # -*- encoding: utf-8 -*-
 from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.mail.message import EmailMessage
 from django.db import models
 from django.db.models.fields import CharField
 from django.db.models.fields.related import ForeignKey
@@ -8,7 +9,8 @@ from django.db.models.fields.related import ForeignKey
 from django.test import TestCase
 
 from auf.django.mailing.models import EntreeLog, Enveloppe, envoyer,\
-    ModeleCourriel, generer_jeton, TAILLE_JETON
+    ModeleCourriel, generer_jeton, TAILLE_JETON, DOUBLONS_ENVOYER,\
+    DOUBLONS_FUSIONNER, FabriqueCourriel
 
 class TestDestinataire(models.Model):
     adresse_courriel = CharField(max_length=128)
@@ -119,6 +121,79 @@ class MailTest(TestCase):
         envoyer(self.modele_courriel.code, 'expediteur@test.org', self.get_site(), 'dummy', limit=1, retry_errors=False)
         self.assertEqual(len(mail.outbox), 2)
 
+    def verifier_fabrique(self, html, headers):
+        sujet = u'sujet accentué'
+        corps = u'corps accentué'
+        fabrique = FabriqueCourriel(sujet, 'expediteur@test.org', html=html,
+            headers=headers)
+        message = fabrique.creer(corps, self.dest1.adresse_courriel).message()
+        reference = EmailMessage(sujet, corps, 'expediteur@test.org',
+            [self.dest1.adresse_courriel], headers=headers)
+        reference.content_subtype = 'html' if html else 'text'
+        reference = reference.message()
+        # seuls la date et l'identifiant diffèrent d'un message à l'autre
+        for nom in ('Date', 'Message-ID'):
+            if nom not in headers:
+                message.replace_header(nom, reference[nom])
+        self.assertEqual(message.as_string(), reference.as_string())
+
+    def test_fabrique_courriel(self):
+        self.verifier_fabrique(True, {'precedence': 'bulk'})
+        self.verifier_fabrique(False, {'precedence': 'bulk'})
+        self.verifier_fabrique(False, {
+            'precedence': 'bulk',
+            'To': u'liste@test.org',
+            'Date': 'Mon, 19 Oct 2026 10:00:00 -0000',
+            'Message-ID': '<fixe@test.org>',
+        })
+        self.verifier_fabrique(True, {'From': u'Expéditeur <exp@test.org>'})
+
+    def test_doublons(self):
+        enveloppe, _ = self.create_enveloppe_params(self.dest1)
+        doublon = TestDestinataire(adresse_courriel=' DEST1@test.org ',
+            nom='nom doublon')
+        doublon.save()
+        enveloppe_doublon, _ = self.create_enveloppe_params(doublon)
+
+        # par défaut le doublon est ignoré, sans être logué
+        envoyer(self.modele_courriel.code, 'expediteur@test.org', self.get_site(), 'dummy')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(EntreeLog.objects.count(), 1)
+
+        # y compris lors d'un envoi ultérieur
+        envoyer(self.modele_courriel.code, 'expediteur@test.org', self.get_site(), 'dummy')
+        self.assertEqual(len(mail.outbox), 1)
+
+        # fusionné, il est logué sans être envoyé
+        envoyer(self.modele_courriel.code, 'expediteur@test.org', self.get_site(), 'dummy',
+            doublons=DOUBLONS_FUSIONNER)
+        self.assertEqual(len(mail.outbox), 1)
+        entrees_log = EntreeLog.objects.filter(enveloppe=enveloppe_doublon)
+        self.assertEqual(len(entrees_log), 1)
+        self.assertEqual(entrees_log[0].adresse, doublon.adresse_courriel)
+        self.assertEqual(entrees_log[0].doublon_de, enveloppe)
+        self.assertEqual(EntreeLog.objects.filter(
+            doublon_de__isnull=True).count(), 1)
+
+        entrees_log.delete()
+        envoyer(self.modele_courriel.code, 'expediteur@test.org', self.get_site(), 'dummy',
+            doublons=DOUBLONS_ENVOYER)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[1].to, [doublon.adresse_courriel])
+
+        # une adresse qui ne change que de casse ou d'espaces n'est pas
+        # considérée comme modifiée
+        self.dest1.adresse_courriel = ' DEST1@Test.org '
+        self.dest1.save()
+        envoyer(self.modele_courriel.code, 'expediteur@test.org', self.get_site(), 'dummy')
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_doublons_valeur_inconnue(self):
+        self.create_enveloppe_params(self.dest1)
+        self.assertRaises(ValueError, envoyer, self.modele_courriel.code,
+            'expediteur@test.org', self.get_site(), 'dummy', doublons='fusion')
+        self.assertEqual(len(mail.outbox), 0)
+
 
 
 